@@ -1,23 +1,186 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for
+from flask import Flask, Request, Response, render_template, request, send_file, redirect, url_for, abort
 import os
+import json
+import itertools
+import zipfile
+from contextlib import closing
+from io import BytesIO
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import pandas as pd
 from fpdf import FPDF
+from pypdf import PdfReader, PdfWriter
+from presort import (
+    MAX_ROWS_IN_MEMORY, external_sort, iter_workbook_groups, iter_workbook_rows, rows_to_frame, zip_sort_key
+)
+
+
+class InMemoryRequest(Request):
+    """Keeps uploaded files in memory instead of spooling them to a temp file."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # MAX_CONTENT_LENGTH bounds how much can end up in this buffer.
+        return BytesIO()
+
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'xlsx', 'xls'}
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Keep a copy of every uploaded workbook in UPLOAD_FOLDER.
+app.config['PERSIST_UPLOADS'] = False
+# Where generated statements are kept. None streams the PDF straight back
+# in the upload response; set to a storage backend to keep it for /download.
+app.config['STATEMENT_STORAGE'] = None
+# Most patients a single preview may render.
+app.config['PREVIEW_MAX_PATIENTS'] = 50
+# Most workbook rows a preview reads while looking for patients.
+app.config['PREVIEW_SCAN_ROWS'] = 20000
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+
+class DiskStorage:
+    """Stores generated files as plain files in a folder.
+
+    Any object with the same ``save(name, data)`` / ``load(name)`` methods
+    can be used as ``STATEMENT_STORAGE`` (e.g. an S3 or database backend).
+    ``load_range(name, offset, length)`` is optional and lets reprints read
+    one patient's segment without fetching the whole file.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.folder, secure_filename(name))
+
+    def save(self, name, data):
+        with open(self._path(name), 'wb') as f:
+            f.write(data)
+
+    def load(self, name):
+        path = self._path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(name)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def load_range(self, name, offset, length):
+        path = self._path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(name)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+def get_storage():
+    storage = app.config['STATEMENT_STORAGE']
+    if storage is None:
+        # Files written by earlier versions still live in UPLOAD_FOLDER.
+        storage = DiskStorage(app.config['UPLOAD_FOLDER'])
+    return storage
+
+
+def pdf_to_bytes(pdf):
+    # fpdf2 returns the document as a bytearray when no file name is given.
+    return bytes(pdf.output())
+
+
+def read_preview_rows(excel_file, limit=None, patient_ids=None, max_rows=None):
+    """Read just the rows of the first ``limit`` patients or of ``patient_ids``.
+
+    "First" is workbook order. The sheet is streamed and reading stops at the
+    first row of patient ``limit + 1``, so rows a patient has further down the
+    sheet are not previewed. Patient IDs can be anywhere, so at most
+    ``max_rows`` rows are searched for them. Legacy .xls files cannot be
+    streamed; only their first ``max_rows`` rows are read.
+    """
+    wanted = {str(p) for p in patient_ids} if patient_ids else None
+    selected = set()
+    rows = []
+    header = None
+    try:
+        with closing(iter_workbook_rows(excel_file)) as workbook_rows:
+            for scanned, (header, row) in enumerate(workbook_rows):
+                if max_rows is not None and scanned >= max_rows:
+                    break
+                patient_id = row[header.index('Patient ID')]
+                if patient_id is None:
+                    continue
+                patient_id = str(patient_id)
+                if patient_id not in selected:
+                    if wanted is not None:
+                        if patient_id not in wanted:
+                            continue
+                    elif limit is not None and len(selected) >= limit:
+                        break
+                    selected.add(patient_id)
+                rows.append(row)
+    except zipfile.BadZipFile:
+        excel_file.seek(0)
+        df = pd.read_excel(excel_file, nrows=max_rows)
+        ids = df['Patient ID'].astype(str)
+        if wanted is not None:
+            return df[ids.isin(wanted)]
+        # Same cut-off as the streamed read: up to the next patient's first row.
+        return df[ids.isin(ids.unique()[:limit]).cummin()]
+    if not rows:
+        return pd.DataFrame(columns=['Patient ID', 'Patient Name'])
+    return rows_to_frame(rows, header)
+
+
+class ZipStream:
+    """Write-only sink for zipfile that hands out what was written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
 class StatementGenerator:
-    def __init__(self, excel_file_path):
-        self.df = pd.read_excel(excel_file_path)
+    def __init__(self, excel_file=None, df=None, presort=None, stream=False,
+                 max_rows_in_memory=MAX_ROWS_IN_MEMORY, sort=True):
+        # Accepts a path or any file-like object, e.g. the upload stream,
+        # or an already parsed DataFrame. With stream=True an .xlsx workbook
+        # is streamed and grouped by patient with an external sort instead
+        # of being loaded up front; max_rows_in_memory bounds both that and
+        # the presort. presort='zip' orders patients by ZIP and carrier route.
+        # sort=False keeps patients in workbook order instead of by ID and
+        # name; streamed workbooks are grouped by sorting, so they cannot.
+        if stream and not sort:
+            raise ValueError("sort=False needs the workbook loaded, not streamed")
+        self.excel_file = excel_file
+        self.sort = sort
+        self.presort = presort
+        self.max_rows_in_memory = max_rows_in_memory
+        if df is not None:
+            self.df = df
+        elif stream:
+            self.df = None
+        else:
+            self.df = pd.read_excel(excel_file)
+        # Filled by generate_pdf: str(patient ID) -> name and page range.
+        self.page_index = {}
+        # Shared between the per-patient documents of stream_patient_zip.
+        self._image_cache = None
         self.practice_info = {
             'name': "Family Internal Medicine PA Inc",
             'doctor': "Vinod Kumar Nagabhairu, MD",
@@ -27,31 +190,112 @@ class StatementGenerator:
             'billing_fax': "914-202-0292"
         }
     
-    def generate_pdf(self, output_path):
+    def generate_pdf(self, output=None):
+        """Render all statements.
+
+        ``output`` may be a path or a writable file-like object. When it is
+        None the PDF is returned as bytes without touching the disk.
+        """
+        pdf = self._new_pdf()
+
+        self.page_index = {}
+        for patient_id, patient_name, group in self._patient_groups():
+            first_page = pdf.page + 1
+            self._add_patient_pages(pdf, patient_id, patient_name, group)
+            self.page_index[str(patient_id)] = {
+                'name': patient_name,
+                'first_page': first_page,
+                'last_page': pdf.page
+            }
+
+        data = pdf_to_bytes(pdf)
+        if output is None:
+            return data
+        if hasattr(output, 'write'):
+            output.write(data)
+        else:
+            with open(output, 'wb') as f:
+                f.write(data)
+        return data
+
+    def stream_patient_zip(self):
+        """Yield a ZIP archive of per-patient PDFs chunk by chunk.
+
+        Errors before anything has been yielded are raised. A patient that
+        fails after that is left out and listed in ERRORS.txt, so the
+        archive is never cut short.
+        """
+        stream = ZipStream()
+        errors = []
+        written = False
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for patient_id, patient_name, group in self._patient_groups():
+                filename = self._patient_filename(patient_id, patient_name)
+                try:
+                    data = self._render_patient_pdf(patient_id, patient_name, group)
+                except Exception as e:
+                    if not written:
+                        raise
+                    errors.append(f"{filename}: {e}")
+                    continue
+                archive.writestr(filename, data)
+                written = True
+                yield stream.drain()
+            if errors:
+                archive.writestr('ERRORS.txt', '\n'.join(errors) + '\n')
+        yield stream.drain()
+
+    def _patient_filename(self, patient_id, patient_name):
+        return f"{secure_filename(f'{patient_id}_{patient_name}') or patient_id}.pdf"
+
+    def _render_patient_pdf(self, patient_id, patient_name, group):
+        pdf = self._new_pdf()
+        if self._image_cache is None:
+            self._image_cache = pdf.image_cache
+        else:
+            # fpdf2 lets documents share one image cache; usages decide
+            # which images each document actually embeds. Barcodes are
+            # cached by content, so the cache grows with distinct ZIP codes.
+            self._image_cache.reset_usages()
+            pdf.image_cache = self._image_cache
+        self._add_patient_pages(pdf, patient_id, patient_name, group)
+        return pdf_to_bytes(pdf)
+
+    def _new_pdf(self):
         pdf = FPDF()
         pdf.set_auto_page_break(auto=False)
-        grouped = self.df.groupby(['Patient ID', 'Patient Name'])
-
-        for (patient_id, patient_name), group in grouped:
-            pdf.add_page()
-            self._add_first_page_content(pdf, patient_id, patient_name, group)
-
-            if len(group) > 8:
-                remaining_data = group.iloc[8:]
-                page_num = 2
-                total_pages = 1 + (len(remaining_data) // 25 + (1 if len(remaining_data) % 25 else 0))
-
-                for i in range(0, len(remaining_data), 25):
-                    pdf.add_page()
-                    self._add_continuation_page(
-                        pdf, patient_id, patient_name,
-                        remaining_data.iloc[i:i+25],
-                        page_num, total_pages
-                    )
-                    page_num += 1
-
-        pdf.output(output_path)
-
+        return pdf
+
+    def _patient_groups(self):
+        if self.df is not None:
+            groups = (group for _, group in self.df.groupby(['Patient ID', 'Patient Name'], sort=self.sort))
+            if self.presort == 'zip':
+                # The groups are in memory already; sorted() is stable too.
+                groups = sorted(groups, key=zip_sort_key)
+        else:
+            groups = iter_workbook_groups(self.excel_file, self.max_rows_in_memory)
+            if self.presort == 'zip':
+                groups = external_sort(groups, key=zip_sort_key, max_rows_in_memory=self.max_rows_in_memory)
+        for group in groups:
+            yield group['Patient ID'].iloc[0], group['Patient Name'].iloc[0], group
+
+    def _add_patient_pages(self, pdf, patient_id, patient_name, group):
+        pdf.add_page()
+        self._add_first_page_content(pdf, patient_id, patient_name, group)
+
+        if len(group) > 8:
+            remaining_data = group.iloc[8:]
+            page_num = 2
+            total_pages = 1 + (len(remaining_data) // 25 + (1 if len(remaining_data) % 25 else 0))
+
+            for i in range(0, len(remaining_data), 25):
+                pdf.add_page()
+                self._add_continuation_page(
+                    pdf, patient_id, patient_name,
+                    remaining_data.iloc[i:i+25],
+                    page_num, total_pages
+                )
+                page_num += 1
 
     def _add_first_page_content(self, pdf, patient_id, patient_name, patient_data):
         header_y = 10
@@ -311,8 +555,6 @@ class StatementGenerator:
         pdf.set_draw_color(0, 0, 0)
 
     def _add_patient_address(self, pdf, y_pos, width, patient_data):
-        import os
-        
         start_y = y_pos
         line_height = 4
         left_indent = 15
@@ -342,20 +584,22 @@ class StatementGenerator:
         pdf.set_x(left_indent)
         pdf.cell(0, line_height, address_line2, ln=1)
 
-     
-        barcode_filename = f"temp_barcode_{zip_code}.png"
-        self._generte_posatnet_barcode_image(zip_code, barcode_filename)
+
+        # Rendered in memory; fpdf caches identical images within a document.
+        barcode = BytesIO()
+        self._generate_postnet_barcode_image(zip_code, barcode)
+        barcode.seek(0)
 
         # Add barcode image
         barcode_y = pdf.get_y() + 2
-        pdf.image(barcode_filename, x=left_indent, y=barcode_y, w=50, h=10)
+        pdf.image(barcode, x=left_indent, y=barcode_y, w=50, h=10)
 
-        if os.path.exists(barcode_filename):
-            os.remove(barcode_filename)
 
+    def _generate_postnet_barcode_image(self, zip_code, output):
+        """Helper method to generate POSTNET barcode image dynamically.
 
-    def _generate_postnet_barcode_image(self, zip_code, filename):
-        """Helper method to generate POSTNET barcode image dynamically"""
+        ``output`` is a file name or a binary file-like object.
+        """
         import matplotlib.pyplot as plt
         import numpy as np
 
@@ -390,7 +634,7 @@ class StatementGenerator:
         ax.set_xlim(-1, len(barcode_pattern))
         plt.subplots_adjust(left=0.05, right=0.95)
 
-        plt.savefig(filename, bbox_inches='tight', pad_inches=0.1, dpi=300)
+        plt.savefig(output, format='png', bbox_inches='tight', pad_inches=0.1, dpi=300)
         plt.close()
 
 
@@ -698,6 +942,48 @@ class StatementGenerator:
             align='C'
         )
 
+
+def save_batch(storage, batch, generator, pdf_data):
+    """Store a batch's PDF together with its index, segments and parsed input.
+
+    Every patient's pages are also copied into a standalone PDF segment, and
+    the segments are stored back to back in ``<batch>.segments``. The index
+    maps each patient ID to its page range in the batch PDF and to the byte
+    offset and length of its segment, so a reprint reads only that range.
+    """
+    storage.save(f"{batch}.pdf", pdf_data)
+    reader = PdfReader(BytesIO(pdf_data))
+    segments = BytesIO()
+    patients = {}
+    for patient_id, entry in generator.page_index.items():
+        segment = extract_pages(reader, entry['first_page'], entry['last_page'])
+        patients[patient_id] = dict(entry, offset=segments.tell(), length=len(segment))
+        segments.write(segment)
+    storage.save(f"{batch}.segments", segments.getvalue())
+    index = {'pdf': f"{batch}.pdf", 'segments': f"{batch}.segments", 'patients': patients}
+    storage.save(f"{batch}.index.json", json.dumps(index, default=str).encode('utf-8'))
+    # JSON rather than pickle: storage may be remote and is not trusted to
+    # hand back safe-to-unpickle data.
+    input_json = generator.df.to_json(orient='records', date_format='iso')
+    storage.save(f"{batch}.input.json", input_json.encode('utf-8'))
+
+
+def extract_pages(reader, first_page, last_page):
+    """Copy pages ``first_page``..``last_page`` (1-based) into a new PDF."""
+    writer = PdfWriter()
+    for page_number in range(first_page - 1, last_page):
+        writer.add_page(reader.pages[page_number])
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def load_range(storage, name, offset, length):
+    if hasattr(storage, 'load_range'):
+        return storage.load_range(name, offset, length)
+    return storage.load(name)[offset:offset + length]
+
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
@@ -708,26 +994,100 @@ def upload_file():
             return redirect(request.url)
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(upload_path)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_filename = f"statements_{timestamp}.pdf"
-            output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
+            batch = f"statements_{timestamp}"
+            output_filename = f"{batch}.pdf"
+            storage = app.config['STATEMENT_STORAGE']
             try:
-                generator = StatementGenerator(upload_path)
-                generator.generate_pdf(output_path)
-                return redirect(url_for('download_file', filename=output_filename))
+                if app.config['PERSIST_UPLOADS']:
+                    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                    file.stream.seek(0)
+                presort = 'zip' if request.form.get('presort') else None
+                generator = StatementGenerator(file.stream, presort=presort)
+                if request.form.get('output') == 'zip':
+                    chunks = generator.stream_patient_zip()
+                    # Render the first patient here so that bad input still
+                    # gets an error page rather than a broken download.
+                    first_chunk = next(chunks)
+                    return Response(
+                        itertools.chain([first_chunk], chunks),
+                        mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename={batch}.zip'}
+                    )
+                pdf_data = generator.generate_pdf()
+                if storage is not None:
+                    save_batch(storage, batch, generator, pdf_data)
             except Exception as e:
                 return f"An error occurred: {e}"
+            if storage is None:
+                return send_file(
+                    BytesIO(pdf_data),
+                    mimetype='application/pdf',
+                    as_attachment=True,
+                    download_name=output_filename
+                )
+            return redirect(url_for('download_file', filename=output_filename))
     return render_template('upload.html')
 
+@app.route('/preview', methods=['POST'])
+def preview_file():
+    """Render only the first few patients, or the listed patient IDs."""
+    file = request.files.get('file')
+    if not file or not allowed_file(file.filename):
+        return redirect(url_for('upload_file'))
+    max_patients = app.config['PREVIEW_MAX_PATIENTS']
+    patient_ids = [p.strip() for p in request.form.get('patient_ids', '').split(',') if p.strip()]
+    patient_ids = patient_ids[:max_patients]
+    count = request.form.get('count', default=5, type=int)
+    count = min(max(count, 1), max_patients)
+    scan_rows = app.config['PREVIEW_SCAN_ROWS']
+    try:
+        df = read_preview_rows(file.stream, limit=count, patient_ids=patient_ids, max_rows=scan_rows)
+        if df.empty:
+            return f"No matching patients in the first {scan_rows} rows of the workbook.", 404
+        pdf_data = StatementGenerator(df=df, sort=False).generate_pdf()
+    except Exception as e:
+        return f"An error occurred: {e}"
+    return send_file(
+        BytesIO(pdf_data),
+        mimetype='application/pdf',
+        download_name='statements_preview.pdf'
+    )
+
 @app.route('/download/<filename>')
 def download_file(filename):
+    # Only statements; the batch index and input hold every patient's data.
+    if not filename.lower().endswith('.pdf'):
+        abort(404)
+    try:
+        data = get_storage().load(filename)
+    except FileNotFoundError:
+        abort(404)
     return send_file(
-        os.path.join(app.config['UPLOAD_FOLDER'], filename),
+        BytesIO(data),
+        mimetype='application/pdf',
         as_attachment=True,
         download_name=filename
     )
 
+@app.route('/reprint/<batch>/<patient_id>')
+def reprint_statement(batch, patient_id):
+    """Serve a single patient's statement from a stored batch's segments."""
+    storage = get_storage()
+    try:
+        index = json.loads(storage.load(f"{batch}.index.json"))
+        entry = index['patients'].get(patient_id)
+        if entry is None:
+            abort(404)
+        pdf_data = load_range(storage, index['segments'], entry['offset'], entry['length'])
+    except FileNotFoundError:
+        abort(404)
+    return send_file(
+        BytesIO(pdf_data),
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f"{batch}_{secure_filename(patient_id)}.pdf"
+    )
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
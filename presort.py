@@ -0,0 +1,198 @@
+"""ZIP / carrier-route presort of patient groups for mailing batches.
+
+Groups are sorted with an external merge sort: once more than
+MAX_ROWS_IN_MEMORY rows are buffered, the buffer is sorted and spilled to a
+temporary file as one run, and the runs are merged lazily at the end. Only
+one item per run is held in memory while merging. The same sort groups a
+streamed workbook's rows by patient, so neither step needs the whole
+workbook in memory.
+
+Run ``python presort.py month_end.xlsx statements.pdf`` to render a presorted
+batch from a workbook too large to load with read_excel.
+"""
+import heapq
+import itertools
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+MAX_ROWS_IN_MEMORY = 50000
+
+
+def _zip_digits(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if value is None or pd.isna(value):
+        return ''
+    digits = ''.join(c for c in str(value) if c.isdigit())
+    # Numeric ZIP cells lose their leading zeros.
+    return digits.zfill(5) if len(digits) <= 5 else digits.zfill(9)
+
+
+def zip_sort_key(group):
+    """Sort key for a patient group: ZIP5, carrier route, ZIP+4, patient ID.
+
+    Patients without a ZIP code sort last.
+    """
+    first = group.iloc[0]
+    digits = _zip_digits(first.get('ZipCode'))
+    carrier_route = first.get('Carrier Route', '')
+    carrier_route = '' if carrier_route is None or pd.isna(carrier_route) else str(carrier_route)
+    return (0 if digits else 1, digits[:5], carrier_route, digits[5:], str(first.get('Patient ID', '')))
+
+
+def iter_workbook_rows(excel_file):
+    """Stream the non-empty rows of an .xlsx workbook as ``(header, row)``.
+
+    Rows are read with openpyxl in read-only mode and are plain tuples.
+    """
+    workbook = load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows_iter = workbook.active.iter_rows(values_only=True)
+        header = list(next(rows_iter, ()))
+        for row in rows_iter:
+            if all(value is None for value in row):
+                continue
+            yield header, row
+    finally:
+        workbook.close()
+
+
+def rows_to_frame(rows, header, dtypes=None):
+    """Build a DataFrame from streamed rows with the values read_excel gives.
+
+    Blank cells are None in openpyxl but NaN in read_excel, and a column
+    with blanks must still come out numeric, e.g. an Adjustment column that
+    is empty on every row. ``dtypes`` fixes the column types instead of
+    inferring them from ``rows`` alone.
+    """
+    df = pd.DataFrame(list(rows), columns=header)
+    df = df.astype(object).where(df.notna(), np.nan)
+    return df.infer_objects() if dtypes is None else df.astype(dtypes)
+
+
+def _sheet_dtypes(header, samples):
+    # read_excel infers a column's type from the kinds of value in it, so
+    # one example of each kind gives the same dtypes as the whole sheet.
+    depth = max((len(column) for column in samples), default=0)
+    rows = [
+        [list(column.values())[min(n, len(column) - 1)] if column else None for column in samples]
+        for n in range(max(depth, 1))
+    ]
+    return rows_to_frame(rows, header).dtypes
+
+
+def iter_workbook_groups(excel_file, max_rows_in_memory=MAX_ROWS_IN_MEMORY, tmp_dir=None):
+    """Stream an .xlsx workbook as one DataFrame per patient.
+
+    Groups and their order match ``df.groupby(['Patient ID', 'Patient Name'])``
+    on the full sheet, including patients whose rows are spread over it and
+    dropping rows without an ID or name, and columns have the dtypes
+    read_excel would give the sheet. Rows are grouped with external_sort,
+    so at most ``max_rows_in_memory`` rows are buffered at a time.
+    """
+    rows = iter_workbook_rows(excel_file)
+    first = next(rows, None)
+    if first is None:
+        return
+    header = first[0]
+    id_col = header.index('Patient ID')
+    name_col = header.index('Patient Name')
+
+    def patient_key(row):
+        return row[id_col], row[name_col]
+
+    # One example value per type and column, collected while the rows are
+    # sorted; external_sort reads every row before yielding the first.
+    samples = [{} for _ in header]
+
+    def keyed_rows():
+        for _, row in itertools.chain([first], rows):
+            for column, value in zip(samples, row):
+                column.setdefault(type(value), value)
+            if row[id_col] is not None and row[name_col] is not None:
+                yield row
+
+    sorted_rows = external_sort(
+        keyed_rows(), key=patient_key, size=lambda row: 1,
+        max_rows_in_memory=max_rows_in_memory, tmp_dir=tmp_dir
+    )
+    dtypes = None
+    for _, group_rows in itertools.groupby(sorted_rows, key=patient_key):
+        if dtypes is None:
+            dtypes = _sheet_dtypes(header, samples)
+        yield rows_to_frame(group_rows, header, dtypes)
+
+
+def _spill(run, tmp_dir):
+    spill_file = tempfile.TemporaryFile(dir=tmp_dir)
+    for item in run:
+        pickle.dump(item, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+    spill_file.seek(0)
+    return spill_file
+
+
+def _read_run(spill_file):
+    try:
+        while True:
+            yield pickle.load(spill_file)
+    except EOFError:
+        return
+    finally:
+        spill_file.close()
+
+
+def external_sort(items, key=zip_sort_key, size=len, max_rows_in_memory=MAX_ROWS_IN_MEMORY, tmp_dir=None):
+    """Yield ``items`` stably ordered by ``key``, spilling sorted runs to disk as needed.
+
+    ``size`` gives the number of rows an item counts for, so both patient
+    groups and single rows can be sorted.
+    """
+    spill_files = []
+    buffer = []
+    buffered_rows = 0
+    for item in items:
+        buffer.append((key(item), len(spill_files), len(buffer), item))
+        buffered_rows += size(item)
+        if buffered_rows >= max_rows_in_memory:
+            buffer.sort(key=lambda item: item[:3])
+            spill_files.append(_spill(buffer, tmp_dir))
+            buffer = []
+            buffered_rows = 0
+
+    buffer.sort(key=lambda item: item[:3])
+    if not spill_files:
+        for item in buffer:
+            yield item[3]
+        return
+
+    # Run and position numbers make the merge stable for equal keys.
+    runs = [_read_run(spill_file) for spill_file in spill_files]
+    runs.append(iter(buffer))
+    try:
+        for item in heapq.merge(*runs, key=lambda item: item[:3]):
+            yield item[3]
+    finally:
+        for spill_file in spill_files:
+            spill_file.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from app import StatementGenerator
+
+    parser = argparse.ArgumentParser(description='Render a ZIP-presorted statement batch.')
+    parser.add_argument('workbook')
+    parser.add_argument('output')
+    parser.add_argument('--max-rows', type=int, default=MAX_ROWS_IN_MEMORY,
+                        help='rows buffered before a sorted run is spilled to disk')
+    args = parser.parse_args()
+
+    generator = StatementGenerator(args.workbook, presort='zip', stream=True,
+                                   max_rows_in_memory=args.max_rows)
+    generator.generate_pdf(args.output)
+    print(f"Wrote {len(generator.page_index)} statements to {args.output}")
@@ -0,0 +1,371 @@
+"""Sharded statement conversion over a shared SQLite work queue.
+
+The coordinator splits a workbook's patient groups into shards and stores
+them in a SQLite database on a volume every node can reach. Workers on any
+node claim shards under a time-limited lease, render them with
+StatementGenerator and store the resulting PDF segment back in the queue.
+The coordinator hands expired leases back out and stitches the segments in
+shard order once all of them are done.
+
+Workers renew their lease every third of ``lease_seconds`` while rendering,
+so the lease only has to outlive a worker's heartbeat, not its slowest
+shard. A shard that fails or whose worker dies ``max_attempts`` times is
+marked failed and the batch is reported as failed instead of retried forever.
+
+Run a worker with ``python shard_queue.py worker /shared/queue.db`` and a
+batch with ``python shard_queue.py submit /shared/queue.db input.xlsx out.pdf``.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from io import BytesIO, StringIO
+
+import pandas as pd
+
+from app import StatementGenerator
+from presort import zip_sort_key
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    batch TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    presort TEXT,
+    segment BLOB,
+    error TEXT,
+    PRIMARY KEY (batch, shard)
+)
+"""
+
+
+def encode_shard(df):
+    # JSON rather than pickle: the queue lives on a shared volume and is not
+    # trusted to hand back safe-to-unpickle data. The table orient keeps dtypes.
+    return df.to_json(orient='table', date_format='iso')
+
+
+def decode_shard(payload):
+    return pd.read_json(StringIO(payload), orient='table')
+
+
+def connect(db_path):
+    # Autocommit mode so that each write transaction is opened explicitly
+    # with BEGIN IMMEDIATE and holds the database lock while claiming.
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute(SCHEMA)
+    return conn
+
+
+class BatchFailed(RuntimeError):
+    """Raised when a shard of a batch has used up its attempts."""
+
+
+class ShardCoordinator:
+    def __init__(self, db_path, max_attempts=MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+
+    def submit(self, batch, df, patients_per_shard=200, presort=None):
+        """Split ``df`` into shards of whole patients and queue them.
+
+        With ``presort='zip'`` the shards are cut from the ZIP-sorted patient
+        order and workers keep that order within each shard. Returns the
+        number of shards created.
+        """
+        groups = [group for _, group in df.groupby(['Patient ID', 'Patient Name'])]
+        if presort == 'zip':
+            groups.sort(key=zip_sort_key)
+        shards = [
+            pd.concat(groups[i:i + patients_per_shard])
+            for i in range(0, len(groups), patients_per_shard)
+        ]
+        conn = connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM shards WHERE batch = ?", (batch,))
+            conn.executemany(
+                "INSERT INTO shards (batch, shard, status, max_attempts, payload, presort) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (batch, n, PENDING, self.max_attempts, encode_shard(shard), presort)
+                    for n, shard in enumerate(shards)
+                ]
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return len(shards)
+
+    def progress(self, batch):
+        """Return ``(done, total)`` shard counts for ``batch``."""
+        conn = connect(self.db_path)
+        try:
+            done, total = conn.execute(
+                "SELECT COALESCE(SUM(status = ?), 0), COUNT(*) FROM shards WHERE batch = ?",
+                (DONE, batch)
+            ).fetchone()
+        finally:
+            conn.close()
+        return done, total
+
+    def failures(self, batch):
+        """Return ``[(shard, error)]`` for shards that used up their attempts."""
+        conn = connect(self.db_path)
+        try:
+            return conn.execute(
+                "SELECT shard, error FROM shards WHERE batch = ? AND status = ? ORDER BY shard",
+                (batch, FAILED)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def reclaim_expired(self, batch):
+        """Put shards whose worker let the lease run out back in the queue.
+
+        Shards that have already been attempted as often as the
+        ``max_attempts`` they were submitted with are marked failed instead.
+        Returns the number of shards requeued.
+        """
+        now = time.time()
+        conn = connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE shards SET status = ?, worker = NULL, lease_expires = NULL, "
+                "error = 'lease expired' "
+                "WHERE batch = ? AND status = ? AND lease_expires < ? AND attempts >= max_attempts",
+                (FAILED, batch, CLAIMED, now)
+            )
+            cursor = conn.execute(
+                "UPDATE shards SET status = ?, worker = NULL, lease_expires = NULL "
+                "WHERE batch = ? AND status = ? AND lease_expires < ?",
+                (PENDING, batch, CLAIMED, now)
+            )
+            conn.execute("COMMIT")
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def stitch(self, batch, output=None):
+        """Merge the finished segments in shard order into one PDF.
+
+        ``output`` behaves like in StatementGenerator.generate_pdf.
+        """
+        from pypdf import PdfReader, PdfWriter
+
+        conn = connect(self.db_path)
+        try:
+            rows = conn.execute(
+                "SELECT status, segment FROM shards WHERE batch = ? ORDER BY shard",
+                (batch,)
+            ).fetchall()
+        finally:
+            conn.close()
+        if any(status == FAILED for status, _ in rows):
+            raise BatchFailed(f"Batch {batch} has failed shards: {self.failures(batch)}")
+        if not rows or any(status != DONE for status, _ in rows):
+            raise RuntimeError(f"Batch {batch} is not finished")
+
+        writer = PdfWriter()
+        for _, segment in rows:
+            for page in PdfReader(BytesIO(segment)).pages:
+                writer.add_page(page)
+        buffer = BytesIO()
+        writer.write(buffer)
+        data = buffer.getvalue()
+
+        if output is None:
+            return data
+        if hasattr(output, 'write'):
+            output.write(data)
+        else:
+            with open(output, 'wb') as f:
+                f.write(data)
+        return data
+
+    def wait(self, batch, output=None, poll_interval=5, timeout=None):
+        """Block until every shard is done, reassigning dead workers' shards.
+
+        Raises BatchFailed as soon as a shard has used up its attempts and
+        ValueError if the batch has no shards at all.
+        """
+        if self.progress(batch)[1] == 0:
+            raise ValueError(f"Batch {batch} has no shards; is the workbook empty?")
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.reclaim_expired(batch)
+            failures = self.failures(batch)
+            if failures:
+                raise BatchFailed(f"Batch {batch} has failed shards: {failures}")
+            done, total = self.progress(batch)
+            if done == total:
+                return self.stitch(batch, output)
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError(f"Batch {batch}: {done} of {total} shards done")
+            time.sleep(poll_interval)
+
+    def clear(self, batch):
+        conn = connect(self.db_path)
+        try:
+            conn.execute("DELETE FROM shards WHERE batch = ?", (batch,))
+        finally:
+            conn.close()
+
+
+class ShardWorker:
+    def __init__(self, db_path, worker_id=None, lease_seconds=300):
+        self.db_path = db_path
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds
+
+    def claim(self):
+        """Lease the next pending shard.
+
+        Returns ``(batch, shard, df, presort)`` or None when nothing is pending.
+        """
+        conn = connect(self.db_path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT batch, shard, payload, presort FROM shards WHERE status = ? "
+                "ORDER BY batch, shard LIMIT 1",
+                (PENDING,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            batch, shard, payload, presort = row
+            conn.execute(
+                "UPDATE shards SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE batch = ? AND shard = ?",
+                (CLAIMED, self.worker_id, time.time() + self.lease_seconds, batch, shard)
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return batch, shard, decode_shard(payload), presort
+
+    def complete(self, batch, shard, segment):
+        """Store a rendered segment. Returns False if the lease was lost."""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute(
+                "UPDATE shards SET status = ?, segment = ?, worker = NULL, lease_expires = NULL "
+                "WHERE batch = ? AND shard = ? AND status = ? AND worker = ?",
+                (DONE, segment, batch, shard, CLAIMED, self.worker_id)
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def renew(self, batch, shard):
+        """Extend the lease on a claimed shard. Returns False if it was lost."""
+        conn = connect(self.db_path)
+        try:
+            cursor = conn.execute(
+                "UPDATE shards SET lease_expires = ? "
+                "WHERE batch = ? AND shard = ? AND status = ? AND worker = ?",
+                (time.time() + self.lease_seconds, batch, shard, CLAIMED, self.worker_id)
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def fail(self, batch, shard, error):
+        """Release a shard that raised, or mark it failed after its max_attempts."""
+        conn = connect(self.db_path)
+        try:
+            conn.execute(
+                "UPDATE shards SET status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, "
+                "worker = NULL, lease_expires = NULL, error = ? "
+                "WHERE batch = ? AND shard = ? AND status = ? AND worker = ?",
+                (FAILED, PENDING, error, batch, shard, CLAIMED, self.worker_id)
+            )
+        finally:
+            conn.close()
+
+    def _heartbeat(self, batch, shard, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            if not self.renew(batch, shard):
+                return
+
+    def run_once(self):
+        """Claim and render one shard. Returns False when the queue is empty."""
+        claimed = self.claim()
+        if claimed is None:
+            return False
+        batch, shard, df, presort = claimed
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(batch, shard, stop), daemon=True)
+        heartbeat.start()
+        try:
+            segment = StatementGenerator(df=df, presort=presort).generate_pdf()
+        except Exception as e:
+            self.fail(batch, shard, f"{type(e).__name__}: {e}")
+        else:
+            self.complete(batch, shard, segment)
+        finally:
+            stop.set()
+            heartbeat.join()
+        return True
+
+    def run(self, idle_sleep=5, stop_when_idle=False):
+        while True:
+            if not self.run_once():
+                if stop_when_idle:
+                    return
+                time.sleep(idle_sleep)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker_parser = subparsers.add_parser('worker', help='claim and render shards')
+    worker_parser.add_argument('db')
+    worker_parser.add_argument('--lease', type=int, default=300)
+    worker_parser.add_argument('--exit-when-idle', action='store_true')
+
+    submit_parser = subparsers.add_parser('submit', help='queue a workbook and stitch the result')
+    submit_parser.add_argument('db')
+    submit_parser.add_argument('workbook')
+    submit_parser.add_argument('output')
+    submit_parser.add_argument('--patients-per-shard', type=int, default=200)
+    submit_parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+    submit_parser.add_argument('--presort', choices=['zip'], default=None,
+                               help='order statements by ZIP and carrier route')
+    submit_parser.add_argument('--timeout', type=float, default=None,
+                               help='give up after this many seconds')
+
+    args = parser.parse_args()
+    if args.command == 'worker':
+        ShardWorker(args.db, lease_seconds=args.lease).run(stop_when_idle=args.exit_when_idle)
+    else:
+        coordinator = ShardCoordinator(args.db, max_attempts=args.max_attempts)
+        batch = os.path.splitext(os.path.basename(args.output))[0]
+        count = coordinator.submit(batch, pd.read_excel(args.workbook), args.patients_per_shard,
+                                   presort=args.presort)
+        print(f"Queued {count} shards as batch {batch}")
+        try:
+            coordinator.wait(batch, args.output, timeout=args.timeout)
+        except (BatchFailed, TimeoutError, ValueError) as e:
+            raise SystemExit(str(e))
+        coordinator.clear(batch)
+        print(f"Wrote {args.output}")
@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+SAMPLE = ROOT / 'uploads' / 'Patient_First_statement_-_07282025_1_1_-_Copy.xlsx'
+
+
+@pytest.fixture
+def repo_root(monkeypatch):
+    # Logo paths in the layout are relative to the repository root.
+    monkeypatch.chdir(ROOT)
+    return ROOT
+
+
+@pytest.fixture
+def client(repo_root, tmp_path, monkeypatch):
+    from app import app
+
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setitem(app.config, 'PERSIST_UPLOADS', False)
+    monkeypatch.setitem(app.config, 'STATEMENT_STORAGE', None)
+    (tmp_path / 'uploads').mkdir()
+    return app.test_client()
+
+
+def upload(client, url='/', filename='statements.xlsx', **form):
+    with open(SAMPLE, 'rb') as f:
+        return client.post(url, data={'file': (f, filename), **form})
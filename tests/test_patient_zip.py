@@ -0,0 +1,51 @@
+import zipfile
+from io import BytesIO
+
+import pandas as pd
+import pytest
+from pypdf import PdfReader
+
+from app import StatementGenerator
+from conftest import SAMPLE
+
+pytestmark = pytest.mark.usefixtures('repo_root')
+
+
+def embedded_images(data):
+    return [[image.data for image in page.images] for page in PdfReader(BytesIO(data)).pages]
+
+
+def read_zip(chunks):
+    return zipfile.ZipFile(BytesIO(b''.join(chunks)))
+
+
+def test_one_pdf_per_patient_with_shared_images():
+    generator = StatementGenerator(SAMPLE)
+    archive = read_zip(generator.stream_patient_zip())
+
+    names = archive.namelist()
+    groups = [group for _, group in generator.df.groupby(['Patient ID', 'Patient Name'])]
+    assert len(names) == len(groups)
+    for name, group in zip(names, groups):
+        images = embedded_images(archive.read(name))
+        assert len(images[0]) == 6
+        # Each document embeds exactly what it would on its own.
+        assert images == embedded_images(StatementGenerator(df=group).generate_pdf())
+
+
+def test_failed_patient_is_listed_not_truncated():
+    df = pd.read_excel(SAMPLE)
+    df['Total Balance'] = df['Total Balance'].astype(object)
+    df.loc[df['Patient ID'] == df['Patient ID'].max(), 'Total Balance'] = 'bad'
+
+    archive = read_zip(StatementGenerator(df=df).stream_patient_zip())
+    assert archive.testzip() is None
+    assert archive.namelist()[-1] == 'ERRORS.txt'
+    assert len(archive.namelist()) == df['Patient ID'].nunique()
+
+
+def test_error_before_first_file_is_raised():
+    df = pd.read_excel(SAMPLE)
+    df['Total Balance'] = 'bad'
+    with pytest.raises(ValueError):
+        next(StatementGenerator(df=df).stream_patient_zip())
@@ -0,0 +1,73 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+from presort import external_sort, iter_workbook_groups, zip_sort_key
+
+HEADER = ['Patient ID', 'Patient Name', 'ZipCode', 'Charge']
+ROWS = [
+    (300, 'C', '17055-9049', 1.0),
+    (100, 'A', '08001', 2.0),
+    (300, 'C', '17055-9049', 3.0),
+    (200, 'B', '17050', 4.0),
+    (100, 'A', '08001', 5.0),
+    (None, None, None, None),
+    (200, 'B', '17050', 6.0),
+]
+
+
+def save_workbook(path, header, rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return path
+
+
+@pytest.fixture
+def workbook_path(tmp_path):
+    return save_workbook(tmp_path / 'statements.xlsx', HEADER, ROWS)
+
+
+@pytest.mark.parametrize('max_rows', [2, 1000])
+def test_workbook_groups_match_groupby(workbook_path, max_rows):
+    expected = pd.read_excel(workbook_path).groupby(['Patient ID', 'Patient Name'])
+    groups = list(iter_workbook_groups(workbook_path, max_rows_in_memory=max_rows))
+
+    assert [g['Patient ID'].iloc[0] for g in groups] == [key[0] for key, _ in expected]
+    for group, (_, expected_group) in zip(groups, expected):
+        assert group['Charge'].tolist() == expected_group['Charge'].tolist()
+
+
+def test_workbook_groups_read_blank_cells_like_read_excel(tmp_path):
+    header = ['Patient ID', 'Patient Name', 'CPT', 'Adjustment', 'Comments', 'Date Of Service']
+    path = save_workbook(tmp_path / 'blanks.xlsx', header, [
+        (100, 'A', 99232, None, None, datetime(2025, 5, 28)),
+        (200, 'B', 99233, None, 'call first', None),
+        (100, 'A', None, None, None, datetime(2025, 5, 29)),
+    ])
+    expected = pd.read_excel(path).groupby(['Patient ID', 'Patient Name'])
+
+    groups = list(iter_workbook_groups(path))
+
+    assert len(groups) == 2
+    for group, (_, expected_group) in zip(groups, expected):
+        # Patient B has no blank CPT but still gets the sheet's float column.
+        pd.testing.assert_frame_equal(group, expected_group.reset_index(drop=True))
+
+
+@pytest.mark.parametrize('max_rows', [1, 1000])
+def test_external_sort_orders_by_zip_and_is_stable(max_rows):
+    df = pd.DataFrame(ROWS[:5] + ROWS[6:], columns=HEADER)
+    groups = [group for _, group in df.groupby(['Patient ID', 'Patient Name'])]
+
+    ordered = list(external_sort(groups, key=zip_sort_key, max_rows_in_memory=max_rows))
+    assert [g['Patient ID'].iloc[0] for g in ordered] == [100, 200, 300]
+
+    same_key = list(external_sort(range(10), key=lambda item: item % 2, size=lambda item: 1,
+                                  max_rows_in_memory=max_rows))
+    assert same_key == [0, 2, 4, 6, 8, 1, 3, 5, 7, 9]
@@ -0,0 +1,109 @@
+from io import BytesIO
+
+import pandas as pd
+from openpyxl import load_workbook
+from pypdf import PdfReader
+
+import app as app_module
+from app import read_preview_rows
+from conftest import SAMPLE, upload
+
+# Patient IDs in workbook order; 150014808 has a second run of rows near the end.
+WORKBOOK_ORDER = [150014808, 149491016, 149753131, 149022238, 149880877,
+                  149716115, 147943902, 150006759, 149969516, 149753713]
+
+
+def page_texts(data):
+    return [page.extract_text() for page in PdfReader(BytesIO(data)).pages]
+
+
+def preview_rows(**kwargs):
+    with open(SAMPLE, 'rb') as f:
+        return read_preview_rows(f, **kwargs)
+
+
+def blank_adjustment_workbook():
+    workbook = load_workbook(SAMPLE)
+    sheet = workbook.active
+    column = [cell.value for cell in sheet[1]].index('Adjustment') + 1
+    for row in range(2, sheet.max_row + 1):
+        sheet.cell(row, column).value = None
+    buffer = BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def test_first_patients_stop_reading_at_the_next_patient(monkeypatch):
+    read = []
+    iter_workbook_rows = app_module.iter_workbook_rows
+
+    def counting_rows(excel_file):
+        for header, row in iter_workbook_rows(excel_file):
+            read.append(row)
+            yield header, row
+
+    monkeypatch.setattr(app_module, 'iter_workbook_rows', counting_rows)
+
+    df = preview_rows(limit=2)
+
+    assert df['Patient ID'].unique().tolist() == WORKBOOK_ORDER[:2]
+    assert len(df) == 17
+    # The two patients' rows plus the row that shows the next patient began.
+    assert len(read) == 18
+
+
+def test_first_patients_are_distinct():
+    df = preview_rows(limit=9)
+    assert df['Patient ID'].unique().tolist() == WORKBOOK_ORDER[:9]
+
+
+def test_patient_ids_keep_rows_spread_over_the_sheet():
+    df = preview_rows(patient_ids=['150014808'])
+    assert len(df) == 6
+
+
+def test_patient_id_lookup_is_capped_by_max_rows():
+    assert preview_rows(patient_ids=['149753713'], max_rows=70).empty
+    assert len(preview_rows(patient_ids=['149753713'], max_rows=80)) == 7
+
+
+def test_blank_cells_read_like_read_excel():
+    buffer = blank_adjustment_workbook()
+    expected = pd.read_excel(buffer)
+    buffer.seek(0)
+
+    df = read_preview_rows(buffer, limit=len(WORKBOOK_ORDER))
+
+    # The last patient's second run is before the end, so every row is read.
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_preview_with_blank_numeric_column(client):
+    response = client.post('/preview', data={'file': (blank_adjustment_workbook(), 'statements.xlsx')})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+
+
+def test_preview_keeps_workbook_order(client):
+    response = upload(client, '/preview', count='2')
+
+    text = '\n'.join(page_texts(response.data))
+    assert 0 <= text.index('SAUNDERS, EDWARD') < text.index('THOMPSON, CAROLYN')
+
+
+def test_preview_without_matches_is_not_found(client):
+    response = upload(client, '/preview', patient_ids='123, 456')
+
+    assert response.status_code == 404
+    assert b'No matching patients' in response.data
+
+
+def test_preview_count_is_clamped(client, monkeypatch):
+    from app import app
+    monkeypatch.setitem(app.config, 'PREVIEW_MAX_PATIENTS', 2)
+
+    assert len(page_texts(upload(client, '/preview', count='0').data)) == 1
+    # Two patients: one page, then two.
+    assert len(page_texts(upload(client, '/preview', count='1000').data)) == 3
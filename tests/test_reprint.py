@@ -0,0 +1,71 @@
+import json
+from io import BytesIO
+
+import pytest
+from pypdf import PdfReader
+
+from app import DiskStorage
+from conftest import upload
+
+
+@pytest.fixture
+def storage(client, tmp_path, monkeypatch):
+    from app import app
+    storage = DiskStorage(str(tmp_path / 'statements'))
+    monkeypatch.setitem(app.config, 'STATEMENT_STORAGE', storage)
+    return storage
+
+
+@pytest.fixture
+def batch(client, storage):
+    response = upload(client)
+    assert response.status_code == 302
+    return response.location.rsplit('/', 1)[1][:-len('.pdf')]
+
+
+def page_texts(data):
+    return [page.extract_text() for page in PdfReader(BytesIO(data)).pages]
+
+
+def test_index_covers_every_page_once(storage, batch):
+    index = json.loads(storage.load(f"{batch}.index.json"))
+    entries = sorted(index['patients'].values(), key=lambda entry: entry['first_page'])
+
+    assert len(entries) == 10
+    assert entries[0]['first_page'] == 1
+    assert entries[-1]['last_page'] == len(page_texts(storage.load(f"{batch}.pdf")))
+    for previous, entry in zip(entries, entries[1:]):
+        assert entry['first_page'] == previous['last_page'] + 1
+        assert entry['offset'] == previous['offset'] + previous['length']
+
+
+def test_reprint_serves_the_patients_pages(client, storage, batch):
+    index = json.loads(storage.load(f"{batch}.index.json"))
+    entry = index['patients']['149022238']
+    batch_pages = page_texts(storage.load(f"{batch}.pdf"))
+
+    response = client.get(f"/reprint/{batch}/149022238")
+
+    assert response.status_code == 200
+    assert page_texts(response.data) == batch_pages[entry['first_page'] - 1:entry['last_page']]
+
+
+def test_reprint_without_range_reads(client, storage, batch, monkeypatch):
+    from app import app
+
+    class WholeFileStorage:
+        load = storage.load
+
+    monkeypatch.setitem(app.config, 'STATEMENT_STORAGE', WholeFileStorage())
+    assert len(page_texts(client.get(f"/reprint/{batch}/150006759").data)) == 1
+
+
+def test_reprint_unknown_patient_or_batch(client, batch):
+    assert client.get(f"/reprint/{batch}/999").status_code == 404
+    assert client.get("/reprint/statements_missing/149022238").status_code == 404
+
+
+def test_download_serves_only_pdfs(client, batch):
+    assert client.get(f"/download/{batch}.pdf").status_code == 200
+    for suffix in ('.index.json', '.input.json', '.segments'):
+        assert client.get(f"/download/{batch}{suffix}").status_code == 404
@@ -0,0 +1,165 @@
+import threading
+import time
+from io import BytesIO
+
+import pandas as pd
+import pytest
+from fpdf import FPDF
+from pypdf import PdfReader
+
+import shard_queue
+from shard_queue import BatchFailed, ShardCoordinator, ShardWorker
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'queue.db')
+
+
+@pytest.fixture
+def coordinator(db_path):
+    df = pd.DataFrame({
+        'Patient ID': [1, 1, 2, 3],
+        'Patient Name': ['A', 'A', 'B', 'C'],
+    })
+    coordinator = ShardCoordinator(db_path, max_attempts=2)
+    assert coordinator.submit('batch', df, patients_per_shard=1) == 3
+    return coordinator
+
+
+def make_segment(text):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font('Helvetica', '', 12)
+    pdf.cell(0, 10, text)
+    return bytes(pdf.output())
+
+
+class FakeGenerator:
+    def __init__(self, df, presort=None):
+        self.df = df
+
+    def generate_pdf(self):
+        return make_segment(f"patient {self.df['Patient ID'].iloc[0]}")
+
+
+def test_shard_payload_round_trips_dtypes(db_path):
+    df = pd.DataFrame({
+        'Patient ID': [7, 7],
+        'Patient Name': ['A', 'A'],
+        'ZipCode': ['01234', '01234'],
+        'Total Balance': [12.5, float('nan')],
+        'Date Of Service': pd.to_datetime(['2025-07-01', '2025-07-02']),
+    })
+    ShardCoordinator(db_path).submit('batch', df)
+
+    _, _, shard, _ = ShardWorker(db_path, 'w1').claim()
+    pd.testing.assert_frame_equal(shard, df, check_index_type=False, check_dtype=False)
+    assert shard['ZipCode'].tolist() == ['01234', '01234']
+    assert pd.api.types.is_datetime64_any_dtype(shard['Date Of Service'])
+
+
+def test_max_attempts_is_stored_with_the_shard(db_path):
+    df = pd.DataFrame({'Patient ID': [1], 'Patient Name': ['A']})
+    ShardCoordinator(db_path, max_attempts=1).submit('batch', df)
+
+    # Neither the worker nor a coordinator with another default decides.
+    ShardWorker(db_path, 'dead', lease_seconds=-1).claim()
+    coordinator = ShardCoordinator(db_path, max_attempts=5)
+    assert coordinator.reclaim_expired('batch') == 0
+    assert coordinator.failures('batch') == [(0, 'lease expired')]
+
+
+def test_wait_on_empty_batch_raises(db_path):
+    coordinator = ShardCoordinator(db_path)
+    assert coordinator.submit('batch', pd.DataFrame(columns=['Patient ID', 'Patient Name'])) == 0
+    with pytest.raises(ValueError, match='no shards'):
+        coordinator.wait('batch', poll_interval=0, timeout=1)
+
+
+def test_claim_leases_each_shard_once_in_order(coordinator, db_path):
+    first, second = ShardWorker(db_path, 'w1'), ShardWorker(db_path, 'w2')
+
+    batch, shard, df, presort = first.claim()
+    assert (batch, shard, presort) == ('batch', 0, None)
+    assert df['Patient ID'].tolist() == [1, 1]
+    assert second.claim()[1] == 1
+    assert second.claim()[1] == 2
+    assert first.claim() is None
+
+
+def test_expired_lease_is_reclaimed_and_stale_worker_loses_it(coordinator, db_path):
+    dead = ShardWorker(db_path, 'dead', lease_seconds=-1)
+    live = ShardWorker(db_path, 'live')
+    assert dead.claim()[1] == 0
+
+    assert coordinator.reclaim_expired('batch') == 1
+    assert live.claim()[1] == 0
+    assert not dead.complete('batch', 0, b'stale')
+    assert live.complete('batch', 0, b'fresh')
+    assert coordinator.progress('batch') == (1, 3)
+
+
+def test_live_lease_is_not_reclaimed(coordinator, db_path):
+    ShardWorker(db_path, 'w1').claim()
+    assert coordinator.reclaim_expired('batch') == 0
+
+
+def test_stitch_keeps_shard_order(coordinator, db_path, monkeypatch):
+    monkeypatch.setattr(shard_queue, 'StatementGenerator', FakeGenerator)
+    workers = [ShardWorker(db_path, f"w{n}") for n in range(3)]
+    claims = [worker.claim() for worker in workers]
+    # Finish out of order.
+    for worker, (batch, shard, df, _) in reversed(list(zip(workers, claims))):
+        worker.complete(batch, shard, FakeGenerator(df).generate_pdf())
+
+    data = coordinator.wait('batch', poll_interval=0, timeout=1)
+    texts = [page.extract_text() for page in PdfReader(BytesIO(data)).pages]
+    assert texts == ['patient 1', 'patient 2', 'patient 3']
+
+
+def test_stitch_refuses_unfinished_batch(coordinator):
+    with pytest.raises(RuntimeError):
+        coordinator.stitch('batch')
+
+
+def test_failing_shard_is_retried_then_marked_failed(coordinator, db_path, monkeypatch):
+    class BrokenGenerator(FakeGenerator):
+        def generate_pdf(self):
+            if self.df['Patient ID'].iloc[0] == 2:
+                raise ValueError('bad Total Balance')
+            return super().generate_pdf()
+
+    monkeypatch.setattr(shard_queue, 'StatementGenerator', BrokenGenerator)
+    ShardWorker(db_path, 'w1').run(stop_when_idle=True)
+
+    assert coordinator.progress('batch') == (2, 3)
+    assert coordinator.failures('batch') == [(1, 'ValueError: bad Total Balance')]
+    with pytest.raises(BatchFailed):
+        coordinator.wait('batch', poll_interval=0, timeout=1)
+    with pytest.raises(BatchFailed):
+        coordinator.stitch('batch')
+
+
+def test_shard_whose_workers_keep_dying_is_marked_failed(coordinator, db_path):
+    for _ in range(2):
+        assert ShardWorker(db_path, 'dead', lease_seconds=-1).claim()[1] == 0
+        coordinator.reclaim_expired('batch')
+
+    assert coordinator.failures('batch') == [(0, 'lease expired')]
+
+
+def test_heartbeat_keeps_long_render_leased(coordinator, db_path, monkeypatch):
+    class SlowGenerator(FakeGenerator):
+        def generate_pdf(self):
+            time.sleep(0.6)
+            return super().generate_pdf()
+
+    monkeypatch.setattr(shard_queue, 'StatementGenerator', SlowGenerator)
+    worker = ShardWorker(db_path, 'slow', lease_seconds=0.3)
+    thread = threading.Thread(target=worker.run_once)
+    thread.start()
+    time.sleep(0.45)
+    assert coordinator.reclaim_expired('batch') == 0
+    thread.join()
+    assert coordinator.progress('batch') == (1, 3)
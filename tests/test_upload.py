@@ -0,0 +1,56 @@
+import os
+from io import BytesIO
+
+from pypdf import PdfReader
+
+from app import DiskStorage
+from conftest import upload
+
+
+def page_count(data):
+    return len(PdfReader(BytesIO(data)).pages)
+
+
+def test_upload_returns_pdf_without_touching_disk(client, tmp_path):
+    response = upload(client)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/pdf'
+    assert page_count(response.data) == 15
+    assert os.listdir(tmp_path / 'uploads') == []
+
+
+def test_persist_uploads_keeps_the_workbook(client, tmp_path, monkeypatch):
+    from app import app
+    monkeypatch.setitem(app.config, 'PERSIST_UPLOADS', True)
+
+    response = upload(client, filename='month end.xlsx')
+
+    assert response.mimetype == 'application/pdf'
+    assert os.listdir(tmp_path / 'uploads') == ['month_end.xlsx']
+
+
+def test_storage_backend_redirects_to_download(client, tmp_path, monkeypatch):
+    from app import app
+    storage = DiskStorage(str(tmp_path / 'statements'))
+    monkeypatch.setitem(app.config, 'STATEMENT_STORAGE', storage)
+
+    response = upload(client)
+
+    assert response.status_code == 302
+    filename = response.location.rsplit('/', 1)[1]
+    assert storage.load(filename) == client.get(response.location).data
+
+
+def test_failing_storage_backend_shows_error_page(client, monkeypatch):
+    from app import app
+
+    class BrokenStorage:
+        def save(self, name, data):
+            raise OSError('volume is read-only')
+
+    monkeypatch.setitem(app.config, 'STATEMENT_STORAGE', BrokenStorage())
+
+    response = upload(client)
+    assert response.status_code == 200
+    assert response.data == b'An error occurred: volume is read-only'